@@ -1,20 +1,37 @@
 import os
-import io
 import sys
 import time
+import queue
+import atexit
+import socket
+import struct
+import heapq
+import random
+import hashlib
+import re
 import signal
 import logging
 import datetime
-import schedule
+import collections
+import threading
 import functools
+import itertools
 import subprocess
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import paho.mqtt.client as mqtt
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 
 # 设置日志级别
 LOGGING_LEVEL = os.environ.get('LOGGING_LEVEL', 'INFO')
 logging.basicConfig(level=getattr(logging, LOGGING_LEVEL))
+logger = logging.getLogger(__name__)
+
+# 日志和截图的保存目录，启动时创建一次
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(BASE_DIR, 'logs')
+SCREENSHOT_DIR = os.path.join(BASE_DIR, 'errshot')
+os.makedirs(LOG_DIR, exist_ok=True)
+os.makedirs(SCREENSHOT_DIR, exist_ok=True)
 
 # MQTT设置
 MQTT_BROKER = os.environ.get('MQTT_BROKER', '192.168.11.5')
@@ -22,39 +39,177 @@ MQTT_PORT = int(os.environ.get('MQTT_PORT', 21883))
 MQTT_TOPIC = "home/doorlock/set"
 MQTT_STATE_TOPIC = "home/doorlock/state"
 MQTT_CHECK_TOPIC = "home/doorlock/check_status"
+MQTT_PAYLOAD_UNLOCK = b"UNLOCK"  # MQTT_TOPIC上的解锁指令
+MQTT_PAYLOAD_LOCK = b"LOCK"      # MQTT_TOPIC上的锁定指令
+MQTT_KEEPALIVE = 30
+MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID', 'doorlock-control')  # 固定的客户端ID，多个实例须各不相同
 
 # ADB设置
 ADB_DEVICE = os.environ.get('ADB_DEVICE', '192.168.11.135:5555')
+ADB_PREFIX = ["adb", "-s", ADB_DEVICE]  # 指定设备的adb命令前缀
+ADB_CONNECT = ["adb", "connect", ADB_DEVICE]  # 网络设备的连接命令
 REBOOT_TIME = '03:00'
+REBOOT_SHUTDOWN_GRACE = 10  # 发送重启命令后等待设备断开的时间（秒），避免读到重启前的启动完成标志
+BOOT_POLL_INTERVAL = 2      # 等待重启完成时检查启动标志的间隔（秒）
 CHECK_INTERVAL = 30
 
+# dumpsys window输出中表示屏幕锁定的内容
+SCREEN_LOCKED_PATTERN = "mDreamingLockscreen=true|isKeyguardShowing=true"
+KEYGUARD_SHOWING = f"dumpsys window | grep -qE '{SCREEN_LOCKED_PATTERN}'"
+
+# 屏幕锁定时解锁的shell片段，可与后续命令在同一次adb往返中执行：
+# 先发送keyevent 82，仍锁定时再滑动解锁；最终仍锁定时返回码非0，应以 && 连接后续命令，避免在锁屏界面上点击
+UNLOCK_SCREEN_IF_LOCKED = (
+    f"if {KEYGUARD_SHOWING}; then "
+    "input keyevent 82; sleep 1; "
+    f"if {KEYGUARD_SHOWING}; then input swipe 540 1800 540 800; sleep 2; fi; "
+    f"if {KEYGUARD_SHOWING}; then echo '屏幕解锁失败'; false; fi; "
+    "fi"
+)
+
+# 一次往返中连续点击多个坐标时，两次点击之间在设备上等待的时间（秒）
+TAP_PAUSE = 0.5
+
+# 门锁App的主界面
+APP_ACTIVITY = "com.alpha.lockapp/.MainActivity"
+
+# 读取前台Activity并赋值给$activity的shell片段，多数设备无需root即可执行，读取不到时才使用su
+READ_RESUMED_ACTIVITY = (
+    "activity=$(dumpsys activity activities | grep mResumedActivity); "
+    "[ -n \"$activity\" ] || activity=$(su -c 'dumpsys activity activities | grep mResumedActivity')"
+)
+
+# 在dumpsys window的输出中判断屏幕是否锁定
+SCREEN_LOCKED_RE = re.compile(SCREEN_LOCKED_PATTERN)
+SCREEN_LOCK_CACHE_TTL = 2  # 屏幕锁定状态的缓存时间（秒）
+
+# minicap帧流设置（需预先将minicap及minicap.so推送到设备的MINICAP_DIR）
+MINICAP_ENABLED = os.environ.get('MINICAP_ENABLED', 'false').lower() == 'true'
+MINICAP_DIR = '/data/local/tmp'
+MINICAP_PORT = 1313
+SCREEN_SIZE = "1080x1920"         # 设备屏幕分辨率
+
+SCREENCAP_FORMAT_RGBA_8888 = 1  # 原始screencap头部的像素格式值，像素读取按每像素4字节RGBA处理
+
 # 点击坐标（根据您的应用界面调整）
-UNLOCK_COORDS = "750 1200"        # 解锁按钮的坐标
-LOCK_COORDS = "330 1200"          # 锁定按钮的坐标
-RELEASE_SLEEP_MODE = "530 1440"   # 解除睡眠按钮的坐标
-LAUNCH_OK_BUTTON = "900 1120"     # 启动时允许使用蓝牙OK按键的坐标
+UNLOCK_XY = (750, 1200)           # 解锁按钮的坐标
+LOCK_XY = (330, 1200)             # 锁定按钮的坐标
+RELEASE_SLEEP_XY = (530, 1440)    # 解除睡眠按钮的坐标
+LAUNCH_OK_XY = (900, 1120)        # 启动时允许使用蓝牙OK按键的坐标
 
 # 颜色检查坐标和阈值
-COLOR_CHECK_COORDS = "140 380"
+COLOR_CHECK_XY = (140, 380)
 UNLOCK_COLOR = (194, 23, 45)      # 未锁定状态的红色阈值
 LOCKED_COLOR = (0, 168, 135)      # 锁定状态的绿色阈值
 UNLINKED_COLOR = (130, 130, 130)  # 未连接锁时的灰色阈值
 COLOR_TOLERANCE = 10              # 定义颜色匹配的容差
 
+# 以COLOR_CHECK_XY为中心的十字形采样点，按多数采样点的结果判断状态，避免单个像素受抗锯齿或动画影响
+COLOR_SAMPLE_POINTS = tuple(
+    (COLOR_CHECK_XY[0] + dx, COLOR_CHECK_XY[1] + dy)
+    for dx, dy in ((0, 0), (-2, 0), (2, 0), (0, -2), (0, 2))
+)
+
+# 各状态对应的参考颜色
+REF_COLORS = (
+    ("unlocked", UNLOCK_COLOR),
+    ("locked", LOCKED_COLOR),
+    ("unlinked", UNLINKED_COLOR),
+)
+
+# 每个颜色通道的每个取值(0-255)在容差内的参考颜色位掩码，第i位对应REF_COLORS[i]
+CHANNEL_MASKS = tuple(
+    tuple(
+        sum(1 << i for i, (_, color) in enumerate(REF_COLORS) if abs(value - color[channel]) <= COLOR_TOLERANCE)
+        for value in range(256)
+    )
+    for channel in range(3)
+)
+
+# 点击后等待门锁状态变化的最长时间（秒），轮询间隔从STATE_POLL_MIN开始按STATE_POLL_FACTOR倍增长，最长STATE_POLL_MAX（秒）
+STATE_WAIT_TIMEOUT = 3
+STATE_POLL_MIN = 0.1
+STATE_POLL_MAX = 0.5
+STATE_POLL_FACTOR = 1.7
+
+# 锁定/解锁操作的最多点击次数（含首次）
+LOCK_MAX_ATTEMPTS = 4
+
 # 定时检查门锁状态时间
 START_HOUR = 7
 STOP_HOUR = 22
 
+# 门锁操作后的快速检查：在HOT_CHECK_WINDOW秒内每HOT_CHECK_INTERVAL秒检查一次
+HOT_CHECK_INTERVAL = 10
+HOT_CHECK_WINDOW = 60
+# 上次检查未能得到锁定/未锁定状态时，降低检查频率（分钟）
+COLD_CHECK_INTERVAL = 60
+
 # 控制每日重启
 DAILY_REBOOT_ENABLED = False
 
 # 全局变量用于存储MQTT客户端
 mqtt_client = None
 
+# 持久的adb shell会话，及创建会话时使用的锁
+adb_session = None
+adb_session_lock = threading.Lock()
+
+# 原始screencap输出的头部大小，首次截图时根据系统版本确定
+screencap_header_size = None
+
+# 帧缓冲的宽度（像素），首次截图时从screencap头部读取并确认像素格式
+screen_width = None
+
+# 各组采样点对应的截图命令及每个采样点在输出中的行号，宽度确定后只需计算一次
+screencap_sample_commands = {}
+
+# 最近一次ADB连接检查的结果及时间，用于短时间内跳过重复检查
+adb_connection_cache = {"ok": False, "ts": 0.0}
+
+# 最近一次屏幕锁定检查的结果及时间，用于连续操作时跳过重复检查
+screen_lock_cache = {"locked": False, "ts": None}
+
+# 待执行的MQTT指令，按主题合并，同一主题只保留最新的一条；由后台线程依次执行，避免阻塞MQTT网络循环
+pending_commands = {}
+pending_condition = threading.Condition()
+running_command = None  # 正在执行的指令 (主题, 消息内容)
+
+# 操作手机界面的互斥锁，防止多个线程同时点击造成混乱
+device_lock = threading.Lock()
+
+# 后台保存屏幕截图的线程池，单线程以免多个screencap同时占用ADB
+screenshot_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="screenshot")
+
+# 定时任务的最小堆，元素为 [下次运行时间(monotonic), 序号, 任务函数, 计算下次间隔的函数]；
+# 任务被重新安排时旧元素的任务函数置为None，弹出时跳过
+scheduled_jobs = []
+scheduled_job_entries = {}  # 任务函数 -> 堆中当前有效的元素
+scheduled_job_counter = itertools.count()  # 运行时间相同时按加入顺序排列
+scheduler_lock = threading.Lock()
+# 定时任务被重新安排时唤醒主循环
+scheduler_wakeup = threading.Event()
+
+# 定期检查的频率档位："warm" 为正常间隔，"cold" 为门锁未连接或出错后的低频检查；
+# 在 hot_checks_until（monotonic时间）之前则使用门锁操作后的快速检查
+status_check_tier = "warm"
+hot_checks_until = 0.0
+
+# 最近一次发布到MQTT的门锁状态，用于跳过重复发布
+last_published_state = None
+# 最近一次发布的门锁状态（不含OFFLINE），重连后用于覆盖遗嘱消息留下的OFFLINE
+last_known_state = None
+
+# minicap帧流的后台线程及最新一帧JPEG数据
+frame_stream_thread = None
+latest_frame = None
+
+# 最近一次从minicap帧中读取的像素，键为 (帧摘要, 采样坐标)；画面静止时帧不变，无需重复解码JPEG
+frame_pixel_cache = {"key": None, "pixels": None}
+
 def setup_logging():
     """配置日志系统"""
-    os.makedirs(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs'), exist_ok=True)
-    log_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'doorlock.log')
+    log_file = os.path.join(LOG_DIR, 'doorlock.log')
     
     log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     
@@ -75,62 +230,214 @@ def setup_logging():
     console_handler.setFormatter(log_formatter)
     console_handler.setLevel(LOGGING_LEVEL)
     
-    # 配置根日志记录器
+    # 配置根日志记录器：记录日志的线程只把日志放入队列，由后台线程写入文件和控制台，
+    # 避免MQTT回调和状态检查因写日志而阻塞
     root_logger = logging.getLogger()
     root_logger.setLevel(LOGGING_LEVEL)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    log_queue = queue.Queue(-1)
+    handlers = root_logger.handlers + [file_handler, console_handler]
+    root_logger.handlers = [QueueHandler(log_queue)]
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 退出时写完队列中剩余的日志
+    atexit.register(listener.stop)
 
-def check_adb_connection():
-    """检查ADB连接状态"""
+def check_adb_connection(ttl=30):
+    """
+    检查ADB连接状态
+
+    :param ttl: 上次检查成功后在该时间（秒）内直接复用结果，为0时强制重新检查
+    :return: 已连接返回 True，否则返回 False
+    """
+    if ttl > 0:
+        # 持久的adb shell会话仍在运行说明连接正常
+        if adb_session is not None and adb_session.is_alive():
+            return True
+        if adb_connection_cache["ok"] and time.monotonic() - adb_connection_cache["ts"] < ttl:
+            return True
+    ok = probe_adb_connection()
+    update_adb_connection_cache(ok)
+    return ok
+
+def update_adb_connection_cache(ok):
+    """记录ADB连接检查的结果"""
+    adb_connection_cache["ok"] = ok
+    adb_connection_cache["ts"] = time.monotonic()
+
+def invalidate_adb_connection_cache():
+    """使ADB连接检查的缓存失效，下次检查时重新探测"""
+    adb_connection_cache["ok"] = False
+
+def probe_adb_connection():
+    """执行adb命令探测ADB连接状态"""
     if ':' in ADB_DEVICE:  # 如果包含冒号，表示网络连接
-        cmd = f"adb connect {ADB_DEVICE}"
         try:
-            result = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
-            logging.info(f"ADB网络连接结果: {result.stdout.strip()}")
+            result = subprocess.run(ADB_CONNECT, check=True, capture_output=True, text=True)
+            logger.info("ADB网络连接结果: %s", result.stdout.strip())
             return "connected" in result.stdout.lower()
         except subprocess.CalledProcessError as e:
-            logging.error(f"ADB网络连接失败: {e}")
+            logger.error("ADB网络连接失败: %s", e)
             return False
     else:  # USB连接
-        cmd = "adb devices"
         try:
-            result = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
-            logging.info(f"ADB设备列表: {result.stdout.strip()}")
+            result = subprocess.run(["adb", "devices"], check=True, capture_output=True, text=True)
+            logger.info("ADB设备列表: %s", result.stdout.strip())
             # 检查设备序列号是否在列表中且状态为device
             return f"{ADB_DEVICE}\tdevice" in result.stdout
         except subprocess.CalledProcessError as e:
-            logging.error(f"ADB命令执行失败: {e}")
+            logger.error("ADB命令执行失败: %s", e)
             return False
 
-def reconnect_adb(device):
+def backoff_delay(attempt, base, cap, jitter=0.5):
+    """计算第attempt次重试前的等待时间：指数退避，上限为cap，并加入随机抖动"""
+    return min(cap, base * 2 ** attempt) + random.uniform(0, jitter)
+
+def reconnect_adb():
     '''重新连接adb'''
     max_attempts = 20
     for attempt in range(max_attempts):
-        try:
-            subprocess.run(f"adb connect {device}", shell=True, check=True)
-            if check_adb_connection():
-                logging.info("ADB 重新连接成功")
-                return True
-        except subprocess.CalledProcessError:
-            logging.warning(f"ADB 重连尝试 {attempt + 1} 失败")
-        time.sleep(5)
-    logging.error("ADB 重连失败")
+        if ':' in ADB_DEVICE:
+            # 直接根据adb connect的输出判断，无需再执行一次检查
+            result = subprocess.run(ADB_CONNECT, capture_output=True, text=True, check=False)
+            connected = "connected" in result.stdout.lower()
+            update_adb_connection_cache(connected)
+        else:
+            connected = check_adb_connection(ttl=0)
+        if connected:
+            logger.info("ADB 重新连接成功")
+            return True
+        logger.warning("ADB 重连尝试 %s 失败", attempt + 1)
+        time.sleep(backoff_delay(attempt, base=0.5, cap=4))
+    logger.error("ADB 重连失败")
     return False
 
+class AdbUnavailable(Exception):
+    """无法连接到Android设备"""
+
+class ScreencapParseError(subprocess.CalledProcessError):
+    """截图相关命令的输出无法解析；继承CalledProcessError，调用方按ADB命令失败处理"""
+
+    def __str__(self):
+        return f"无法解析命令 '{self.cmd}' 的输出: {self.output!r}"
+
+class UnsupportedPixelFormat(ScreencapParseError):
+    """原始screencap的像素格式不是RGBA_8888，无法按每像素4字节RGBA读取"""
+
+    def __str__(self):
+        return f"不支持的screencap像素格式: {self.output}，仅支持RGBA_8888({SCREENCAP_FORMAT_RGBA_8888})"
+
+class AdbSession:
+    """持久的adb shell会话，通过stdin逐条发送命令，避免每条命令都启动新的adb进程"""
+    END_MARKER = "__END__"
+    # 结束标记行：标记后只能是返回码，回显的命令行（"echo __END__$?"）不会被误认为结束
+    END_LINE_RE = re.compile(r"(.*)__END__(\d+)")
+
+    def __init__(self, device):
+        self.device = device
+        # 多个线程共用同一会话，命令的写入和输出的读取必须成对进行，不能交错
+        self.lock = threading.Lock()
+        self.proc = subprocess.Popen(
+            ["adb", "-s", device, "shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0
+        )
+
+    def is_alive(self):
+        """会话进程是否仍在运行"""
+        return self.proc.poll() is None
+
+    def send(self, cmd, check=True):
+        """
+        发送一条shell命令并读取输出直到结束标记
+
+        :param cmd: 在设备上执行的shell命令
+        :param check: 返回码非0时是否抛出 CalledProcessError
+        :return: (返回码, 输出)
+        """
+        with self.lock:
+            return self._send(cmd, check)
+
+    def _send(self, cmd, check):
+        """在持有锁的情况下发送命令并读取输出"""
+        try:
+            self.proc.stdin.write(f"{cmd}; echo {self.END_MARKER}$?\n".encode('utf-8'))
+        except OSError:
+            self.close()
+            raise subprocess.CalledProcessError(-1, cmd, "adb shell会话已断开")
+        try:
+            returncode, output = self._read_output(cmd)
+        except BaseException:
+            # 未读完的输出和结束标记会留在管道中被下一条命令读到，因此出错时必须丢弃整个会话
+            self.close()
+            raise
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, output)
+        return returncode, output
+
+    def _read_output(self, cmd):
+        """读取命令输出直到结束标记行，返回 (返回码, 输出)"""
+        lines = []
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                # 会话已断开
+                raise subprocess.CalledProcessError(-1, cmd, "\n".join(lines))
+            line = line.decode('utf-8', errors='replace').rstrip('\r\n')
+            match = self.END_LINE_RE.fullmatch(line)
+            if match is None:
+                lines.append(line)
+                continue
+            if match.group(1):  # 命令输出末尾没有换行
+                lines.append(match.group(1))
+            return int(match.group(2)), "\n".join(lines)
+
+    def close(self):
+        """关闭会话"""
+        if self.is_alive():
+            self.proc.kill()
+        self.proc.wait()
+
+def close_adb_session():
+    """关闭持久的adb shell会话"""
+    global adb_session
+    with adb_session_lock:
+        if adb_session is not None:
+            adb_session.close()
+            adb_session = None
+
+def adb_shell(cmd, check=True):
+    """通过持久的adb shell会话执行命令，会话断开时自动重新打开"""
+    global adb_session
+    with adb_session_lock:
+        if adb_session is None or not adb_session.is_alive():
+            adb_session = AdbSession(ADB_DEVICE)
+        session = adb_session
+    return session.send(cmd, check)
+
 def ensure_adb_connection(func):
     '''装饰器用以在执行任何adb命令前先检查adb连接并尝试重连'''
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         try:
             if not check_adb_connection():
-                logging.warning(f"ADB 连接断开，尝试重新连接...")
-                if not reconnect_adb(ADB_DEVICE):
-                    logging.error("ADB连接失败, 无法执行操作!")
-                    raise
-            return func(*args, **kwargs)
+                logger.warning("ADB 连接断开，尝试重新连接...")
+                if not reconnect_adb():
+                    logger.error("ADB连接失败, 无法执行操作!")
+                    raise AdbUnavailable(f"无法连接到 {ADB_DEVICE}")
+                # 重连后旧的adb shell会话已不可用
+                close_adb_session()
+            elif adb_session is not None and not adb_session.is_alive():
+                logger.warning("adb shell会话已断开，重新打开...")
+                close_adb_session()
+            result = func(*args, **kwargs)
+            # adb命令执行成功说明连接正常，顺延缓存的有效期
+            update_adb_connection_cache(True)
+            return result
         except subprocess.CalledProcessError as e:
-            logging.error(f"执行 ADB 命令时出错: {e}")
+            logger.error("执行 ADB 命令时出错: %s", e)
+            invalidate_adb_connection_cache()
             raise
 
     return wrapper
@@ -138,53 +445,78 @@ def ensure_adb_connection(func):
 @ensure_adb_connection
 def reboot_android_device():
     """重启Android设备"""
-    logging.info("正在重启Android设备...")
-    cmd = f"adb -s {ADB_DEVICE} reboot"
+    logger.info("正在重启Android设备...")
+    cmd = ADB_PREFIX + ["reboot"]
     try:
-        subprocess.run(cmd, shell=True, check=True)
-        logging.info("重启命令已发送，等待设备重启...")
-        time.sleep(60)  # 等待1分钟让设备完成重启
+        subprocess.run(cmd, check=True)
+        logger.info("重启命令已发送，等待设备重启...")
+        close_adb_session()
+        invalidate_adb_connection_cache()
+        time.sleep(REBOOT_SHUTDOWN_GRACE)
         if wait_for_device_after_reboot():
-            logging.info("设备重启完成")
+            logger.info("设备重启完成")
             if unlock_device():
-                logging.info("设备解锁成功")
+                logger.info("设备解锁成功")
             else:
-                logging.error("设备解锁失败")
+                logger.error("设备解锁失败")
         else:
-            logging.error("等待设备重启超时")
+            logger.error("等待设备重启超时")
     except subprocess.CalledProcessError as e:
-        logging.error(f"重启设备时出错: {e}")
+        logger.error("重启设备时出错: %s", e)
 
-def wait_for_device_after_reboot(max_wait_time=300, check_interval=10):
+def wait_for_device_after_reboot(max_wait_time=300, interval=BOOT_POLL_INTERVAL):
     """
-    等待设备在重启后重新连接
+    等待设备在重启后重新连接并完成启动
     
     :param max_wait_time: 最大等待时间（秒）
-    :param check_interval: 检查间隔（秒）
-    :return: 如果设备成功连接返回 True，否则返回 False
+    :param interval: 两次检查之间的等待时间（秒）
+    :return: 如果设备完成启动返回 True，否则返回 False
     """
-    logging.info(f"等待设备重新连接，最大等待时间: {max_wait_time}秒")
-    start_time = time.time()
+    logger.info("等待设备完成启动，最大等待时间: %s秒", max_wait_time)
+    deadline = time.monotonic() + max_wait_time
     
-    while time.time() - start_time < max_wait_time:
-        if reconnect_adb(ADB_DEVICE):
-            logging.info("设备已重新连接")
+    while time.monotonic() < deadline:
+        if is_boot_completed():
+            logger.info("设备已重新连接并完成启动")
+            update_adb_connection_cache(True)
             return True
-        time.sleep(check_interval)
+        time.sleep(max(0, min(interval, deadline - time.monotonic())))
     
-    logging.error(f"等待设备重新连接超时（{max_wait_time}秒）")
+    logger.error("等待设备完成启动超时（%s秒）", max_wait_time)
     return False
 
+def is_boot_completed():
+    """重新连接设备并检查sys.boot_completed，设备未连接或仍在启动中时返回 False"""
+    try:
+        if ':' in ADB_DEVICE:
+            subprocess.run(ADB_CONNECT, capture_output=True, check=False, timeout=10)
+        result = subprocess.run(ADB_PREFIX + ["shell", "getprop", "sys.boot_completed"],
+                                capture_output=True, text=True, check=False, timeout=10)
+    except subprocess.TimeoutExpired:
+        return False
+    return result.stdout.strip() == "1"
+
 @ensure_adb_connection
-def is_screen_locked():
-    """检查屏幕是否锁定"""
-    cmd = f"adb -s {ADB_DEVICE} shell dumpsys window | grep -E 'mDreamingLockscreen=true|isKeyguardShowing=true'"
+def is_screen_locked(ttl=SCREEN_LOCK_CACHE_TTL):
+    """
+    检查屏幕是否锁定
+
+    :param ttl: 在该时间（秒）内复用上次的检查结果，为0时强制重新检查
+    :return: 屏幕锁定返回 True，否则返回 False
+    """
+    checked_at = screen_lock_cache["ts"]
+    if ttl > 0 and checked_at is not None and time.monotonic() - checked_at < ttl:
+        return screen_lock_cache["locked"]
     try:
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        return bool(result.stdout.strip())  # 如果有输出则表示屏幕锁定
+        # 在本地用正则匹配，省去手机上额外的grep进程
+        _, output = adb_shell("dumpsys window")
+        locked = SCREEN_LOCKED_RE.search(output) is not None
     except subprocess.CalledProcessError as e:
-        logging.error(f"检查屏幕锁定状态失败: {e}")
+        logger.error("检查屏幕锁定状态失败: %s", e)
         return False  # 失败时假设未锁定以尝试直接执行命令
+    screen_lock_cache["locked"] = locked
+    screen_lock_cache["ts"] = time.monotonic()
+    return locked
 
 def ensure_screen_unlocked(func):
     """装饰器：确保在执行函数前屏幕处于解锁状态"""
@@ -193,315 +525,721 @@ def ensure_screen_unlocked(func):
         try:
             # 检查屏幕是否锁定
             if is_screen_locked():
-                logging.info(f"执行{func.__name__}前检测到屏幕锁定，正在解锁...")
+                logger.info("执行%s前检测到屏幕锁定，正在解锁...", func.__name__)
                 if not unlock_device_new():
-                    logging.error(f"屏幕解锁失败，无法执行{func.__name__}!")
+                    logger.error("屏幕解锁失败，无法执行%s!", func.__name__)
                     raise Exception("解锁屏幕失败")
-                logging.info("屏幕解锁成功，继续执行操作")
+                logger.info("屏幕解锁成功，继续执行操作")
             # 执行原函数
             return func(*args, **kwargs)
         except Exception as e:
-            logging.error(f"确保屏幕解锁时出错: {e}")
+            logger.error("确保屏幕解锁时出错: %s", e)
             raise
     return wrapper
 
 def unlock_device_new():
     """使用keyevent 82解锁设备屏幕"""
-    logging.info("正在使用keyevent 82解锁设备屏幕...")
-    cmd = f"adb -s {ADB_DEVICE} shell input keyevent 82"
+    logger.info("正在使用keyevent 82解锁设备屏幕...")
     try:
-        subprocess.run(cmd, shell=True, check=True)
-        logging.info("发送解锁命令成功")
+        adb_shell("input keyevent 82")
+        logger.info("发送解锁命令成功")
         time.sleep(1)  # 等待解锁命令生效
         
         # 验证解锁是否成功
-        if is_screen_locked():
-            logging.warning("keyevent 82未能解锁屏幕，尝试滑动解锁...")
+        if is_screen_locked(ttl=0):
+            logger.warning("keyevent 82未能解锁屏幕，尝试滑动解锁...")
             # 尝试滑动解锁作为备选方案
-            cmd_swipe = f"adb -s {ADB_DEVICE} shell input swipe 540 1800 540 800"
-            subprocess.run(cmd_swipe, shell=True, check=True)
+            adb_shell("input swipe 540 1800 540 800")
             time.sleep(2)  # 等待滑动解锁动作完成
             
-            if is_screen_locked():
-                logging.error("所有解锁尝试均失败")
+            if is_screen_locked(ttl=0):
+                logger.error("所有解锁尝试均失败")
                 return False
         
-        logging.info("设备屏幕解锁成功")
+        logger.info("设备屏幕解锁成功")
         return True
     except subprocess.CalledProcessError as e:
-        logging.error(f"解锁设备屏幕时出错: {e}")
+        logger.error("解锁设备屏幕时出错: %s", e)
         return False
 
 @ensure_adb_connection
 def unlock_device():
     """解锁设备屏幕"""
-    logging.info("正在解锁设备屏幕...")
+    logger.info("正在解锁设备屏幕...")
     # 模拟从屏幕底部向上滑动的操作, 屏幕分辨率1080x1920
-    cmd = f"adb -s {ADB_DEVICE} shell input swipe 540 1800 540 800"
     try:
-        subprocess.run(cmd, shell=True, check=True)
-        logging.info("设备屏幕解锁成功")
+        adb_shell("input swipe 540 1800 540 800")
+        logger.info("设备屏幕解锁成功")
         time.sleep(3)  # 等待解锁动画完成
     except subprocess.CalledProcessError as e:
-        logging.error(f"解锁设备屏幕时出错: {e}")
+        logger.error("解锁设备屏幕时出错: %s", e)
         return False
     return True
 
 @ensure_screen_unlocked
 def turn_off_screen():
     """关闭手机屏幕函数"""
-    cmd = f"adb -s {ADB_DEVICE} shell CLASSPATH=/mnt/sdcard/Documents/DisplayToggle.dex app_process / DisplayToggle 0"
     try:
-        result = subprocess.run(cmd, shell=True, check=False, capture_output=True, text=True)
-        if "Display mode: 0" in result.stdout:
-            logging.info("成功关闭手机屏幕.")
+        _, output = adb_shell("CLASSPATH=/mnt/sdcard/Documents/DisplayToggle.dex app_process / DisplayToggle 0", check=False)
+        if "Display mode: 0" in output:
+            logger.info("成功关闭手机屏幕.")
             return True
         else:
-            logging.error(f"关闭手机屏幕失败: {result.stdout}")
+            logger.error("关闭手机屏幕失败: %s", output)
             return False
     except Exception as e:
-        logging.error(f"执行关闭手机屏幕命令时发生错误: {e}")
+        logger.error("执行关闭手机屏幕命令时发生错误: %s", e)
         return False
 
 def on_connect(client, userdata, flags, rc, properties=None):
     """MQTT连接成功后的回调函数"""
-    logging.info(f"连接成功，返回码: {rc}")
-    client.subscribe(MQTT_TOPIC)
-    client.subscribe(MQTT_CHECK_TOPIC)
+    global last_published_state
+    logger.info("连接成功，返回码: %s", rc)
+    # 断线期间遗嘱消息可能已将状态改为OFFLINE：已知门锁状态时立即重新发布，否则尽快检查一次
+    last_published_state = None
+    if last_known_state is not None:
+        publish_state(client, last_known_state, force=True)
+    else:
+        reschedule_job(periodic_status_check, 0)
+    # 在一个SUBSCRIBE请求中订阅所有主题；即使服务器恢复了原会话也重新订阅，以便订阅的主题有变化时生效
+    client.subscribe([(topic, 0) for topic in SUBSCRIBE_TOPICS])
+
+def on_disconnect(client, userdata, disconnect_flags, reason_code, properties=None):
+    """MQTT连接断开后的回调函数，非主动断开时由MQTT网络线程按reconnect_delay_set的设置自动重连"""
+    if reason_code == 0:
+        logger.info("MQTT连接已断开")
+        return
+    logger.warning("MQTT连接意外断开，原因: %s，正在重新连接...", reason_code)
+
+def queue_command(client, msg, handler):
+    """将MQTT指令加入待执行队列，同一主题未执行的旧指令被新指令取代"""
+    command = (msg.topic, msg.payload)
+    with pending_condition:
+        if command == running_command and msg.topic not in pending_commands:
+            logger.info("相同指令正在执行，忽略: %s %s", msg.topic, msg.payload)
+            return
+        if msg.topic in pending_commands:
+            logger.info("合并未执行的指令: %s", msg.topic)
+        pending_commands[msg.topic] = (command, handler, client)
+        pending_condition.notify()
+
+def command_worker():
+    """后台线程：依次执行待执行的MQTT指令"""
+    global running_command
+    while True:
+        with pending_condition:
+            while not pending_commands:
+                pending_condition.wait()
+            topic = next(iter(pending_commands))
+            running_command, handler, client = pending_commands.pop(topic)
+        try:
+            handler(client)
+        except Exception as e:
+            logger.error("处理MQTT消息时出错: %s", e)
+        finally:
+            with pending_condition:
+                running_command = None
+
+# (主题, 消息内容) 对应的处理函数，消息内容为None时匹配该主题的任意消息
+MESSAGE_HANDLERS = {
+    (MQTT_TOPIC, MQTT_PAYLOAD_UNLOCK): lambda client: control_lock("unlock", client),
+    (MQTT_TOPIC, MQTT_PAYLOAD_LOCK): lambda client: control_lock("lock", client),
+    (MQTT_CHECK_TOPIC, None): lambda client: check_and_publish_status(client, force=True),
+}
+
+# 需要订阅的主题
+SUBSCRIBE_TOPICS = sorted({topic for topic, _ in MESSAGE_HANDLERS})
 
 def on_message(client, userdata, msg):
     """接收到MQTT消息后的回调函数"""
-    logging.info(f"收到MQTT消息: {msg.topic} {str(msg.payload)}")
-    if msg.topic == MQTT_TOPIC:
-        if msg.payload == b"UNLOCK":
-            control_lock("unlock", client)
-        elif msg.payload == b"LOCK":
-            control_lock("lock", client)
-    elif msg.topic == MQTT_CHECK_TOPIC:
-        check_and_publish_status(client)
+    logger.info("收到MQTT消息: %s %s", msg.topic, msg.payload)
+    handler = MESSAGE_HANDLERS.get((msg.topic, msg.payload)) or MESSAGE_HANDLERS.get((msg.topic, None))
+    if handler:
+        queue_command(client, msg, handler)
+    else:
+        logger.warning("未知的MQTT消息: %s %s", msg.topic, msg.payload)
+
+def unlocked_tap(*points):
+    """在一次adb shell往返中完成：屏幕锁定时先解锁，然后依次点击各坐标，两次点击之间在设备上等待TAP_PAUSE秒"""
+    taps = f"; sleep {TAP_PAUSE}; ".join(f"input tap {x} {y}" for x, y in points)
+    return adb_shell(f"{UNLOCK_SCREEN_IF_LOCKED} && {{ {taps}; }}")
 
-@ensure_screen_unlocked
 def release_sleep_mode():
-    """解除App的睡眠模式"""
-    cmd_release_sleep = f"adb -s {ADB_DEVICE} shell input tap {RELEASE_SLEEP_MODE}"
+    """解除App的睡眠模式，已能读出锁定/未锁定状态时说明不在睡眠模式，跳过点击"""
+    if awake_lock_status() is not None:
+        logger.debug("App未处于睡眠模式，无需解除")
+        return
     try:
-        subprocess.run(cmd_release_sleep, shell=True, check=True)
-        logging.info("执行【スリープモード解除】操作成功.")
-        time.sleep(1)  # 等待1秒
+        unlocked_tap(RELEASE_SLEEP_XY)
+        logger.info("执行【スリープモード解除】操作成功.")
+        # 睡眠模式下状态图标为灰色，等待其变为锁定/未锁定颜色
+        wait_for_state(("locked", "unlocked"), timeout=1)
     except subprocess.CalledProcessError as e:
-        logging.error(f"执行【スリープモード解除】操作失败: {e}")
+        logger.error("执行【スリープモード解除】操作失败: %s", e)
 
-@ensure_screen_unlocked
-def check_lock_status():
-    """检查门锁状态"""
-    release_sleep_mode()
-    image = capture_screen()
-    pixel = image.getpixel(tuple(map(int, COLOR_CHECK_COORDS.split())))
-    logging.info(f"在坐标处检测到颜色: {pixel}")
-
-    def color_matches(color1, color2, tolerance):
-        return all(abs(c1 - c2) <= tolerance for c1, c2 in zip(color1[:3], color2[:3]))
-
-    if color_matches(pixel, UNLOCK_COLOR, COLOR_TOLERANCE):
-        logging.info("检测到未锁定状态（红色）.")
-        return "unlocked"
-    elif color_matches(pixel, LOCKED_COLOR, COLOR_TOLERANCE):
-        logging.info("检测到锁定状态（绿色）.")
-        return "locked"
-    elif color_matches(pixel, UNLINKED_COLOR, COLOR_TOLERANCE):
-        logging.warning("检测到未连接状态（灰色）.")
-        return "unlinked"
+def awake_lock_status():
+    """
+    读取门锁状态，用于判断App是否处于睡眠模式（睡眠模式下状态图标为灰色）
+
+    :return: 能读出锁定/未锁定状态时返回该状态，否则（睡眠模式、其他界面或读取出错）返回 None
+    """
+    try:
+        status, _ = read_lock_status()
+    except (subprocess.CalledProcessError, AdbUnavailable):
+        return None
+    return status if status in ("locked", "unlocked") else None
+
+def check_lock_status(release_sleep=True):
+    """
+    检查门锁状态
+
+    :param release_sleep: 是否先解除App的睡眠模式，调用方已解除时传入 False
+    """
+    if release_sleep:
+        release_sleep_mode()
+    status, pixel = read_lock_status()
+    logger.info("在坐标处检测到颜色: %s", pixel)
+
+    if status == "unlocked":
+        logger.info("检测到未锁定状态（红色）.")
+    elif status == "locked":
+        logger.info("检测到锁定状态（绿色）.")
+    elif status == "unlinked":
+        logger.warning("检测到未连接状态（灰色）.")
     else:
-        logging.warning(f"无法匹配颜色: {pixel}")
+        logger.warning("无法匹配颜色: %s", pixel)
+    return status
+
+def wait_for_state(targets, timeout=STATE_WAIT_TIMEOUT):
+    """
+    以指数退避的间隔轮询状态像素，直到门锁状态变为targets之一或超时
+
+    响应快的设备在首次几次短间隔的轮询中即可确认，响应慢时间隔逐渐拉长以减少截图次数
+
+    :param targets: 期望的状态，如 ("locked",)
+    :param timeout: 最长等待时间（秒）
+    :return: 最后一次读取到的状态
+    """
+    deadline = time.monotonic() + timeout
+    delay = STATE_POLL_MIN
+    while True:
+        status, _ = read_lock_status()
+        remaining = deadline - time.monotonic()
+        if status in targets or remaining <= 0:
+            return status
+        time.sleep(min(delay, remaining))
+        delay = min(delay * STATE_POLL_FACTOR, STATE_POLL_MAX)
+
+def read_lock_status():
+    """
+    在同一帧中读取所有采样点的颜色并投票
+
+    :return: (状态, 中心像素)
+    """
+    pixels = capture_pixels(COLOR_SAMPLE_POINTS)
+    return vote_status(pixels), pixels[0]
+
+def vote_status(pixels):
+    """返回能匹配的采样点中最多的状态，没有匹配或票数相同时返回 unknown"""
+    votes = collections.Counter(classify_color(pixel) for pixel in pixels)
+    votes.pop("unknown", None)
+    ranked = votes.most_common(2)
+    if not ranked or (len(ranked) == 2 and ranked[0][1] == ranked[1][1]):
         return "unknown"
+    return ranked[0][0]
 
-@ensure_adb_connection
-def capture_screen():
-    """捕获Android设备屏幕截图"""
-    cmd = f"adb -s {ADB_DEVICE} exec-out screencap -p"
-    result = subprocess.run(cmd, shell=True, capture_output=True)
-    return Image.open(io.BytesIO(result.stdout))
+def classify_color(pixel):
+    """
+    通过预先计算的通道位掩码判断像素对应的状态，三个通道都在容差内的参考颜色即为匹配
 
-@ensure_screen_unlocked
-def control_lock(action, client, retry=3):
-    """控制门锁的锁定或解锁"""
-    release_sleep_mode()
+    :param pixel: RGB(A) 像素
+    :return: "unlocked"、"locked"、"unlinked" 或 "unknown"
+    """
+    hits = CHANNEL_MASKS[0][pixel[0]] & CHANNEL_MASKS[1][pixel[1]] & CHANNEL_MASKS[2][pixel[2]]
+    if not hits:
+        return "unknown"
+    if not hits & (hits - 1):
+        # 只有一个参考颜色匹配（参考颜色互不重叠时总是如此），直接由位序号得到状态
+        return REF_COLORS[hits.bit_length() - 1][0]
+    # 多个参考颜色都在容差内时，取各通道最大差值最小的一个
+    matches = (REF_COLORS[i] for i in range(len(REF_COLORS)) if hits >> i & 1)
+    return min(matches, key=lambda ref: max(abs(p - c) for p, c in zip(pixel, ref[1])))[0]
+
+def capture_pixels(points):
+    """读取屏幕上多个坐标的像素颜色，优先使用minicap帧流中的最新一帧"""
+    frame = latest_frame
+    if frame is not None:
+        key = (hashlib.blake2b(frame, digest_size=16).digest(), points)
+        if frame_pixel_cache["key"] == key:
+            return frame_pixel_cache["pixels"]
+        # 只有minicap的JPEG帧需要解码，PIL在此时才导入
+        import io
+        from PIL import Image
+        # load()返回的像素访问对象直接索引解码后的缓冲区，不像getpixel()每次都做类型分派
+        image = Image.open(io.BytesIO(frame)).load()
+        pixels = [image[x, y][:3] for x, y in points]
+        frame_pixel_cache["key"] = key
+        frame_pixel_cache["pixels"] = pixels
+        return pixels
+    return capture_pixels_by_screencap(points)
+
+@ensure_adb_connection
+def capture_pixels_by_screencap(points):
+    """
+    通过原始格式的screencap读取多个像素的颜色，省去设备端PNG编码和本地解码
 
-    coords = UNLOCK_COORDS if action == "unlock" else LOCK_COORDS
-    cmd = f"adb -s {ADB_DEVICE} shell input tap {coords}"
+    在设备上截取覆盖所有采样点的一段帧缓冲，用od按每像素一行转为文本，再用sed只保留采样点所在的行，
+    一次截图中的所有采样点只有几行文本经过网络
+    """
+    cmd, lines, point_lines = get_screencap_sample_command(points)
+    _, output = adb_shell(cmd)
     try:
-        subprocess.run(cmd, shell=True, check=True)
-        logging.info(f"执行{action}操作")
-        time.sleep(3)  # 等待操作完成
-        
-        # 取得最新锁定状态
-        status = check_lock_status()
-        
-        # 只有在操作成功时提前返回
-        if (action == "unlock" and status == "unlocked") or (action == "lock" and status == "locked"):
-            logging.info(f"{action}操作成功.")
-            client.publish(MQTT_STATE_TOPIC, status.upper())
-            return
+        rows = [tuple(map(int, row.split()[:3])) for row in output.splitlines() if row.strip()]
+    except ValueError:
+        raise ScreencapParseError(0, cmd, output)
+    if len(rows) != len(lines) or any(len(row) != 3 for row in rows):
+        raise ScreencapParseError(0, cmd, output)
+    by_line = dict(zip(lines, rows))
+    return [by_line[line] for line in point_lines]
 
-        # 对所有不成功的情况统一处理（包括 unlinked 状态）
-        logging.warning(f"{action}操作未成功，当前状态: {status}")
-        
-        # 重试逻辑
-        if retry > 0:
-            logging.warning(f"{action}操作未成功,重试...")
-            save_screenshot(action, True)  # 保存屏幕截图
-            retry -= 1
-            control_lock(action, client, retry)  # 重试
-        else:
-            logging.error(f"{action}操作失败!")
-            client.publish(MQTT_STATE_TOPIC, "UNKNOWN")
-            save_screenshot(action)  # 保存屏幕截图
-    except subprocess.CalledProcessError as e:
-        logging.error(f"执行{action}操作失败: {e}")
-        client.publish(MQTT_STATE_TOPIC, "ERROR")
-        save_screenshot(action)  # 保存屏幕截图
+def get_screencap_sample_command(points):
+    """
+    生成读取采样点的截图命令，结果按采样点缓存
 
-@ensure_adb_connection
-def save_screenshot(action, retry=False):
-    """保存屏幕截图（用于调试）"""
-    logging.info("开始保存屏幕截图...")
+    :return: (命令, 输出中依次出现的行号, 每个采样点对应的行号)
+    """
+    sample = screencap_sample_commands.get(points)
+    if sample is None:
+        width = get_screen_width()
+        indices = [y * width + x for x, y in points]
+        first = min(indices)
+        point_lines = [index - first + 1 for index in indices]
+        lines = sorted(set(point_lines))
+        # 像素为RGBA各1字节，tail -c +N从第N个字节（从1开始）输出；
+        # 会话中stderr与stdout合并，screencap的警告（如多显示器提示）须丢弃，否则会被当作像素行
+        start = get_screencap_header_size() + first * 4 + 1
+        length = (max(indices) - first + 1) * 4
+        script = ";".join(f"{line}p" for line in lines)
+        cmd = f"screencap 2>/dev/null | tail -c +{start} | head -c {length} | od -An -tu1 -v -w4 | sed -n '{script}'"
+        sample = screencap_sample_commands[points] = (cmd, lines, point_lines)
+    return sample
+
+def get_screencap_header_size():
+    """原始screencap的头部大小：宽、高、格式各4字节，Android 9(API 28)起多了4字节色彩空间"""
+    global screencap_header_size
+    if screencap_header_size is None:
+        cmd = "getprop ro.build.version.sdk"
+        _, sdk = adb_shell(cmd)
+        try:
+            screencap_header_size = 16 if int(sdk.strip()) >= 28 else 12
+        except ValueError:
+            raise ScreencapParseError(0, cmd, sdk)
+    return screencap_header_size
+
+def get_screen_width():
+    """帧缓冲的宽度，即原始screencap头部的第一个32位整数；同时确认头部第三个整数（像素格式）为RGBA_8888"""
+    global screen_width
+    if screen_width is None:
+        cmd = "screencap 2>/dev/null | head -c 12 | od -An -tu4"
+        _, output = adb_shell(cmd)
+        try:
+            width, _, pixel_format = map(int, output.split())
+        except ValueError:
+            raise ScreencapParseError(0, cmd, output)
+        if pixel_format != SCREENCAP_FORMAT_RGBA_8888:
+            raise UnsupportedPixelFormat(0, cmd, pixel_format)
+        screen_width = width
+    return screen_width
+
+def start_minicap():
+    """转发minicap端口并在设备上启动minicap"""
+    cmd_forward = ADB_PREFIX + ["forward", f"tcp:{MINICAP_PORT}", "localabstract:minicap"]
+    subprocess.run(cmd_forward, check=True)
+    cmd = ADB_PREFIX + ["shell", f"LD_LIBRARY_PATH={MINICAP_DIR}", f"{MINICAP_DIR}/minicap", "-P", f"{SCREEN_SIZE}@{SCREEN_SIZE}/0"]
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def recv_exactly(sock, size):
+    """从socket读取指定长度的数据"""
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("minicap连接已关闭")
+        buf.extend(chunk)
+    return bytes(buf)
+
+def frame_stream_worker():
+    """
+    后台线程：持续读取minicap帧流，只保留最新一帧
+
+    minicap仅在画面变化时才发送新帧，因此保存最后一帧供反复读取，
+    而不是使用会被取走的队列。出错时重连ADB并重启minicap。
+    """
+    global latest_frame
+    while True:
+        minicap_proc = None
+        try:
+            minicap_proc = start_minicap()
+            time.sleep(2)  # 等待minicap启动
+            with socket.create_connection(("127.0.0.1", MINICAP_PORT), timeout=10) as sock:
+                sock.settimeout(None)  # 画面静止时不会有新帧，不能设置读取超时
+                # banner: 版本(1字节) + banner长度(1字节) + 其余信息
+                _, banner_length = recv_exactly(sock, 2)
+                recv_exactly(sock, banner_length - 2)
+                logger.info("minicap帧流已连接")
+                while True:
+                    (frame_size,) = struct.unpack("<I", recv_exactly(sock, 4))
+                    latest_frame = recv_exactly(sock, frame_size)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            logger.warning("minicap帧流中断: %s，正在重启...", e)
+        latest_frame = None
+        if minicap_proc:
+            minicap_proc.kill()
+        reconnect_adb()
+        time.sleep(5)
+
+def start_frame_stream():
+    """启动minicap帧流后台线程（仅启动一次）"""
+    global frame_stream_thread
+    if not MINICAP_ENABLED or frame_stream_thread is not None:
+        return
+    frame_stream_thread = threading.Thread(target=frame_stream_worker, name="frame-stream", daemon=True)
+    frame_stream_thread.start()
+
+def control_lock(action, client, max_attempts=LOCK_MAX_ATTEMPTS):
+    """控制门锁的锁定或解锁，未成功时重试，最多点击max_attempts次"""
+    with device_lock:
+        coords = UNLOCK_XY if action == "unlock" else LOCK_XY
+        target = "unlocked" if action == "unlock" else "locked"
+        # 需要解除睡眠模式时，解除和操作按钮的点击在同一次adb往返中完成
+        release_sleep = awake_lock_status() is None
+        try:
+            for attempt in range(1, max_attempts + 1):
+                if release_sleep:
+                    unlocked_tap(RELEASE_SLEEP_XY, coords)
+                    logger.info("执行【スリープモード解除】及%s操作", action)
+                else:
+                    unlocked_tap(coords)
+                    logger.info("执行%s操作", action)
+            
+                # 等待门锁状态变为目标状态，一旦变化立即返回
+                status = wait_for_state((target,))
+                if status == target:
+                    break
+
+                # 对所有不成功的情况统一处理（包括 unlinked 状态）
+                logger.warning("%s操作未成功，当前状态: %s", action, status)
+                if attempt < max_attempts:
+                    logger.warning("%s操作未成功,重试...", action)
+                    frame = latest_frame
+                    future = screenshot_pool.submit(save_screenshot, action, True, frame)  # 后台保存屏幕截图
+                    if frame is None:
+                        # 没有帧流时需在重试点击前截图，否则截到的是重试后的画面
+                        future.result()
+                    # 灰色图标也可能是App又进入了睡眠模式，此时在下次点击前再次解除
+                    release_sleep = status == "unlinked"
+
+            if status == target:
+                logger.info("%s操作成功.", action)
+                publish_state(client, status.upper())
+                start_hot_status_checks()
+            else:
+                logger.error("%s操作失败!", action)
+                publish_state(client, "UNKNOWN")
+                screenshot_pool.submit(save_screenshot, action, False, latest_frame)  # 后台保存屏幕截图
+        except subprocess.CalledProcessError as e:
+            logger.error("执行%s操作失败: %s", action, e)
+            publish_state(client, "ERROR")
+            screenshot_pool.submit(save_screenshot, action, False, latest_frame)  # 后台保存屏幕截图
+
+def save_screenshot(action, retry=False, frame=None):
+    """
+    保存屏幕截图（用于调试）
+
+    :param action: 执行的操作，用于文件名
+    :param retry: 是否为重试前的截图
+    :param frame: minicap帧流中的JPEG数据，提供时直接写入文件而不再执行screencap
+    """
+    logger.info("开始保存屏幕截图...")
     current_time = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    filename = f"{'@retry_' if retry else ''}{action}_{current_time}.png"
-    file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'errshot', filename)
+    extension = "jpg" if frame is not None else "png"
+    filename = f"{'@retry_' if retry else ''}{action}_{current_time}.{extension}"
+    file_path = os.path.join(SCREENSHOT_DIR, filename)
     
-    cmd = f"adb -s {ADB_DEVICE} exec-out screencap -p > {file_path}"
     try:
-        subprocess.run(cmd, shell=True, check=True)
-        logging.info(f"屏幕截图已保存: {filename}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"保存屏幕截图失败: {e}")
+        if frame is not None:
+            with open(file_path, "wb") as f:
+                f.write(frame)
+        else:
+            write_screencap(file_path)
+        logger.info("屏幕截图已保存: %s", filename)
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        logger.error("保存屏幕截图失败: %s", e)
+
+@ensure_adb_connection
+def write_screencap(file_path):
+    """
+    执行原始格式的screencap并在本地编码为PNG写入文件
+
+    手机上编码PNG较慢且会与App争抢CPU，因此只传输原始帧缓冲，在本地以最快的压缩级别编码
+    """
+    # 只在保存截图时才需要PIL，状态检查不导入
+    import PIL
+    from PIL import Image
+    # 记录Pillow版本，便于确认使用的是Pillow还是Pillow-SIMD
+    logger.debug("Pillow版本: %s", PIL.__version__)
+    header_size = get_screencap_header_size()
+    # 丢弃screencap的警告输出，避免混入帧缓冲数据
+    cmd = ADB_PREFIX + ["exec-out", "screencap 2>/dev/null"]
+    data = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    if len(data) < header_size:
+        raise ScreencapParseError(0, cmd, f"输出只有{len(data)}字节")
+    width, height, pixel_format = struct.unpack_from("<III", data)
+    if pixel_format != SCREENCAP_FORMAT_RGBA_8888:
+        raise UnsupportedPixelFormat(0, cmd, pixel_format)
+    pixels = memoryview(data)[header_size:]
+    if len(pixels) < width * height * 4:
+        raise ScreencapParseError(0, cmd, f"{width}x{height}的帧缓冲只有{len(pixels)}字节")
+    image = Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, 1)
+    image.save(file_path, "PNG", compress_level=1)
 
 def if_app_is_not_running_then_open_it():
     """如果APP没有在运行则启动它"""
     if not is_app_running():
-        logging.info("应用未运行，正在启动应用...")
+        logger.info("应用未运行，正在启动应用...")
         launch_app()
 
 @ensure_screen_unlocked
 def is_app_running():
     """检查指定的应用是否在前台运行"""
-    cmd = "adb shell \"su -c 'dumpsys activity activities | grep mResumedActivity'\""
     try:
-        output = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT).decode('utf-8')
-        return "com.alpha.lockapp/.MainActivity" in output
+        _, output = adb_shell(f"{READ_RESUMED_ACTIVITY}; echo \"$activity\"")
+        return APP_ACTIVITY in output
     except subprocess.CalledProcessError:
-        logging.error("检查应用状态时出错!")
+        logger.error("检查应用状态时出错!")
         # 检查应用状态出错不意味着应用未在运行无需执行启动应用逻辑否则会导致错误
         return True
 
 @ensure_screen_unlocked
 def launch_app():
     """启动指定的应用并点击OK按钮"""
-    cmd = "adb shell am start -n com.alpha.lockapp/.MainActivity"
     try:
-        subprocess.run(cmd, shell=True, check=True)
-        logging.info("应用启动命令已执行...")
+        adb_shell(f"am start -n {APP_ACTIVITY}")
+        logger.info("应用启动命令已执行...")
         time.sleep(5)  # 等待5秒让应用启动
         
         # 点击OK按钮
-        cmd_click = f"adb -s {ADB_DEVICE} shell input tap {LAUNCH_OK_BUTTON}"
-        subprocess.run(cmd_click, shell=True, check=True)
-        logging.info("已点击OK按钮. 等待15秒与门锁连接...")
+        adb_shell(f"input tap {LAUNCH_OK_XY[0]} {LAUNCH_OK_XY[1]}")
+        logger.info("已点击OK按钮. 等待15秒与门锁连接...")
         time.sleep(15)  # 等待15秒让应用与门锁连接
-        logging.info("连接成功.")
+        logger.info("连接成功.")
     except subprocess.CalledProcessError as e:
-        logging.error(f"启动应用或点击OK按钮失败: {e}")
+        logger.error("启动应用或点击OK按钮失败: %s", e)
 
-def check_and_publish_status(client):
-    """检查锁状态并发布到MQTT"""
-    if_app_is_not_running_then_open_it()
+def publish_state(client, state, force=False):
+    """发布门锁状态到MQTT（保留消息），状态未变化时跳过"""
+    global last_published_state, last_known_state
+    if state == last_published_state and not force:
+        logger.debug("门锁状态未变化，跳过发布: %s", state)
+        return
+    client.publish(MQTT_STATE_TOPIC, state, retain=True)
+    last_published_state = state
+    if state != "OFFLINE":
+        last_known_state = state
 
-    status = check_lock_status()
-    if status == "unlocked":
-        logging.info("检查结果: 门锁已解锁")
-        client.publish(MQTT_STATE_TOPIC, "UNLOCKED")
-    elif status == "locked":
-        logging.info("检查结果: 门锁已锁定")
-        client.publish(MQTT_STATE_TOPIC, "LOCKED")
-    elif status == "unlinked":
-        logging.warning("检查结果: 门锁未连接")
-        client.publish(MQTT_STATE_TOPIC, "UNLINKED")
-    else:
-        logging.warning("检查结果: 无法确定门锁状态")
-        client.publish(MQTT_STATE_TOPIC, "UNKNOWN")
-    return status
+def check_app_and_release_sleep_mode():
+    """
+    在一次adb shell往返中检查App是否在前台运行，在前台时同时点击解除睡眠模式
+
+    :return: App在前台运行且已点击解除睡眠返回 True，否则返回 False
+    """
+    script = (
+        f"{UNLOCK_SCREEN_IF_LOCKED} && {{ "
+        f"{READ_RESUMED_ACTIVITY}; "
+        "echo \"$activity\"; "
+        f"case \"$activity\" in *{APP_ACTIVITY}*) input tap {RELEASE_SLEEP_XY[0]} {RELEASE_SLEEP_XY[1]};; esac; "
+        "}"
+    )
+    try:
+        _, output = adb_shell(script, check=False)
+    except subprocess.CalledProcessError as e:
+        logger.error("检查应用状态时出错: %s", e)
+        return False
+    return APP_ACTIVITY in output
+
+def check_and_publish_status(client, force=False):
+    """
+    检查锁状态并发布到MQTT
+
+    :param force: 为True时即使状态未变化也发布，用于响应主动的检查请求
+    """
+    with device_lock:
+        # 上一次操作后App仍未进入睡眠模式时，直接使用读到的状态
+        status = awake_lock_status()
+        if status is None:
+            if check_app_and_release_sleep_mode():
+                # 睡眠模式下状态图标为灰色，等待其变为锁定/未锁定颜色
+                wait_for_state(("locked", "unlocked"), timeout=1)
+            else:
+                # App不在前台或检查出错时按原流程处理，避免在其他界面上点击
+                if_app_is_not_running_then_open_it()
+                release_sleep_mode()
+            status = check_lock_status(release_sleep=False)
+        if status == "unlocked":
+            logger.info("检查结果: 门锁已解锁")
+            publish_state(client, "UNLOCKED", force=force)
+        elif status == "locked":
+            logger.info("检查结果: 门锁已锁定")
+            publish_state(client, "LOCKED", force=force)
+        elif status == "unlinked":
+            logger.warning("检查结果: 门锁未连接")
+            publish_state(client, "UNLINKED", force=force)
+        else:
+            logger.warning("检查结果: 无法确定门锁状态")
+            publish_state(client, "UNKNOWN", force=force)
+        return status
 
 def periodic_status_check():
-    """定期检查门锁状态的函数"""
-    current_time = datetime.datetime.now().time()
-    # 在特定时间段内检查门锁状态
-    if datetime.time(START_HOUR, 0) <= current_time <= datetime.time(STOP_HOUR, 0):
-        check_and_publish_status(mqtt_client)
+    """定期检查门锁状态的函数，并根据结果调整之后的检查频率"""
+    global status_check_tier
+    try:
+        status = check_and_publish_status(mqtt_client)
+    except Exception:
+        status_check_tier = "cold"
+        raise
+    status_check_tier = "warm" if status in ("locked", "unlocked") else "cold"
 
-def schedule_daily_reboot():
-    """安排每天凌晨3点重启设备"""
-    schedule.every().day.at("03:00").do(daily_reboot_and_initialize)
+def start_hot_status_checks():
+    """门锁操作成功后的一段时间内缩短检查间隔，尽快发现状态的再次变化"""
+    global hot_checks_until
+    hot_checks_until = time.monotonic() + HOT_CHECK_WINDOW
+    reschedule_job(periodic_status_check, HOT_CHECK_INTERVAL)
 
 def daily_reboot_and_initialize():
     """每日重启和初始化流程"""
     if not DAILY_REBOOT_ENABLED:
-        logging.info("每日重启功能已禁用，跳过重启")
+        logger.info("每日重启功能已禁用，跳过重启")
         return
-    reboot_android_device()
-    retry_count = 3
-    while retry_count > 0:
-        if initialize_system():
-            logging.info("每日重启和初始化完成")
-            return
-        else:
-            logging.error(f"初始化失败，剩余重试次数: {retry_count-1}")
-            retry_count -= 1
-            time.sleep(60)  # 等待1分钟后重试
-    logging.critical("每日重启后初始化失败，请手动检查设备状态")
-    if not unlock_device():
-        logging.error("无法解锁设备屏幕!")
-        return False
+    with device_lock:
+        reboot_android_device()
+        max_attempts = 3
+        for attempt in range(max_attempts):
+            if initialize_system():
+                logger.info("每日重启和初始化完成")
+                return
+            logger.error("初始化失败，剩余重试次数: %s", max_attempts - attempt - 1)
+            time.sleep(backoff_delay(attempt, base=15, cap=300))
+        logger.critical("每日重启后初始化失败，请手动检查设备状态")
+        if not unlock_device():
+            logger.error("无法解锁设备屏幕!")
+            return False
 
 def initialize_system():
     """系统初始化"""
-    if not check_adb_connection():
-        logging.error("无法连接到Android设备, 请检查网络连接和ADB设置!")
+    if not check_adb_connection(ttl=0):
+        logger.error("无法连接到Android设备, 请检查网络连接和ADB设置!")
         return False
     time.sleep(10)
 
     # 如果程序没有在运行则启动
     if_app_is_not_running_then_open_it()
     time.sleep(10)
+    # 启动屏幕帧流
+    start_frame_stream()
     # 关闭屏幕
     turn_off_screen()
     return True
 
+def seconds_until(time_of_day):
+    """计算距离下一次到达每日时刻（HH:MM）的秒数"""
+    now = datetime.datetime.now()
+    hour, minute = map(int, time_of_day.split(':'))
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= now:
+        target += datetime.timedelta(days=1)
+    return (target - now).total_seconds()
+
+def seconds_until_next_status_check():
+    """
+    计算距下一次定期检查的秒数
+
+    门锁操作后的快速检查期间使用HOT_CHECK_INTERVAL；否则按档位使用CHECK_INTERVAL或COLD_CHECK_INTERVAL，
+    且不在START_HOUR到STOP_HOUR之外的时间段安排检查
+    """
+    if time.monotonic() < hot_checks_until:
+        return HOT_CHECK_INTERVAL
+    interval = COLD_CHECK_INTERVAL if status_check_tier == "cold" else CHECK_INTERVAL
+    next_run = datetime.datetime.now() + datetime.timedelta(minutes=interval)
+    if datetime.time(START_HOUR, 0) <= next_run.time() <= datetime.time(STOP_HOUR, 0):
+        return interval * 60
+    return seconds_until(f"{START_HOUR:02d}:00")
+
+def add_job(func, next_delay):
+    """添加定时任务，next_delay() 返回距下一次运行的秒数"""
+    with scheduler_lock:
+        push_job(func, next_delay, next_delay())
+
+def push_job(func, next_delay, delay):
+    """将任务以delay秒后运行放入堆中，调用方需持有scheduler_lock"""
+    entry = [time.monotonic() + delay, next(scheduled_job_counter), func, next_delay]
+    scheduled_job_entries[func] = entry
+    heapq.heappush(scheduled_jobs, entry)
+
+def reschedule_job(func, delay):
+    """将定时任务的下一次运行改为delay秒后，并唤醒主循环"""
+    with scheduler_lock:
+        entry = scheduled_job_entries.get(func)
+        if entry is None:
+            return
+        entry[2] = None  # 作废原来的元素
+        push_job(func, entry[3], delay)
+    scheduler_wakeup.set()
+
 def schedule_tasks():
     """安排所有定时任务"""
-    schedule.every().day.at(REBOOT_TIME).do(daily_reboot_and_initialize)
-    schedule.every(CHECK_INTERVAL).minutes.do(periodic_status_check)
+    add_job(daily_reboot_and_initialize, lambda: seconds_until(REBOOT_TIME))
+    add_job(periodic_status_check, seconds_until_next_status_check)
 
 def run_pending_and_get_next_run():
-    """检查到下一个定时任务的时长"""
-    schedule.run_pending()
-    return schedule.idle_seconds()
+    """运行到期的定时任务，返回到下一个定时任务的时长"""
+    while True:
+        with scheduler_lock:
+            # 丢弃已作废的元素
+            while scheduled_jobs[0][2] is None:
+                heapq.heappop(scheduled_jobs)
+            entry = scheduled_jobs[0]
+            wait_time = entry[0] - time.monotonic()
+            if wait_time > 0:
+                return wait_time
+            heapq.heappop(scheduled_jobs)
+        _, _, func, next_delay = entry
+        try:
+            func()
+        except Exception as e:
+            logger.error("定时任务%s出错: %s", func.__name__, e)
+        with scheduler_lock:
+            # 运行期间被重新安排过的任务已有新的元素，不再重复加入
+            if scheduled_job_entries.get(func) is entry:
+                push_job(func, next_delay, next_delay())
 
 def signal_handler(signum, frame):
     """处理终止信号"""
     signal_name = signal.Signals(signum).name
-    logging.info(f"收到终止信号 {signal_name}，程序正在关闭...")
+    logger.info("收到终止信号 %s，程序正在关闭...", signal_name)
     
     # 清理 MQTT 连接
     if mqtt_client:
         try:
-            mqtt_client.publish(MQTT_STATE_TOPIC, "OFFLINE")
+            publish_state(mqtt_client, "OFFLINE", force=True)
             mqtt_client.loop_stop()
             mqtt_client.disconnect()
-            logging.info("MQTT 连接已关闭")
+            logger.info("MQTT 连接已关闭")
         except Exception as e:
-            logging.error(f"关闭 MQTT 连接时发生错误: {e}")
+            logger.error("关闭 MQTT 连接时发生错误: %s", e)
+
+    close_adb_session()
     
-    logging.info("程序已完全关闭")
+    logger.info("程序已完全关闭")
     sys.exit(0)
 
 # 主程序
@@ -512,38 +1250,44 @@ if __name__ == "__main__":
 
     # 设置日志
     setup_logging()
-    logging.info("智能门锁程序启动...")
+    logger.info("智能门锁程序启动...")
     
-    # 启动定时任务
-    schedule_tasks()
-
-    if not initialize_system():
-        logging.error("初始化失败，程序退出")
-        exit(1)
-
     # MQTT
-    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    # 订阅使用QoS 0，服务器默认不为离线的会话积压QoS 0消息，重连后不会执行断线期间过时的开关锁指令
+    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=MQTT_CLIENT_ID, clean_session=False)
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
+    mqtt_client.on_disconnect = on_disconnect
+    # 程序异常退出时由服务器发布OFFLINE状态
+    mqtt_client.will_set(MQTT_STATE_TOPIC, "OFFLINE", qos=1, retain=True)
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=32)
+    # 限制未确认和排队的消息数量，断线期间发布的状态不会无限堆积
+    mqtt_client.max_inflight_messages_set(20)
+    mqtt_client.max_queued_messages_set(1000)
 
     try:
-        # MQTT连接
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)        
-        # 启动MQTT客户端循环
+        # MQTT连接在后台线程中建立和维持，初始化和重启设备等耗时操作期间也能按时发送心跳；
+        # 服务器暂时无法连接时网络线程会自动重试
+        mqtt_client.connect_async(MQTT_BROKER, MQTT_PORT, MQTT_KEEPALIVE)
         mqtt_client.loop_start()
-        
-        # 运行定时任务
+
+        if not initialize_system():
+            logger.error("初始化失败，程序退出")
+            exit(1)
+
+        # 初始化完成后才开始执行MQTT指令；初始化期间收到的指令已按主题合并，只执行最新的一条
+        threading.Thread(target=command_worker, name="mqtt-command", daemon=True).start()
+
+        # 启动定时任务，并立即检查一次，覆盖上次退出时保留的OFFLINE状态
+        schedule_tasks()
+        reschedule_job(periodic_status_check, 0)
+
+        # 主线程只负责运行定时任务
         while True:
-            # 运行待执行的任务并获取下一个任务的等待时间
+            # 运行待执行的任务，等待到下一个任务或任务被重新安排
             wait_time = run_pending_and_get_next_run()
-            # 如果下一个任务在30秒以上，稍微休眠长一点
-            if wait_time > 30:
-                time.sleep(30)
-            elif wait_time > 0:
-                time.sleep(wait_time)
-            else:
-                # 如果没有等待时间，仍然短暂休眠以避免CPU过载
-                time.sleep(1)
+            scheduler_wakeup.wait(max(0.1, wait_time))
+            scheduler_wakeup.clear()
     except Exception as e:
-        logging.error(f"运行时错误: {e}")
+        logger.error("运行时错误: %s", e)
         exit(1)
\ No newline at end of file